@@ -1,16 +1,20 @@
 """
 optimal_location.py
 
-Versão atualizada: paralelização das avaliações do GA, validações mais robustas para evitar 400 Bad Request
-(e mensagens de erro mais informativas), e otimizações pequenas (busca de nó mais próximo vetorizada).
+Versão atualizada: avaliação vetorizada do GA, validações mais robustas para evitar 400 Bad Request
+(e mensagens de erro mais informativas), e otimizações pequenas (busca de nó mais próximo via KD-tree).
 
 Principais alterações:
 - Normalização dos tipos do marcador (aceita 'produtor'/'mercado' e 'producer'/'buyer').
 - Validação explícita dos campos do marcador com erros HTTP claros (evita 400 genérico).
-- Paralelização do passo de avaliação da população no GA usando ThreadPoolExecutor (paraleliza fitness ao avaliar uma população grande).
+- Fitness de todos os candidatos calculado de uma vez com NumPy (q @ D_prod + d @ D_buy); a população é um vetor de índices.
+- Evolução do GA num ProcessPoolExecutor persistente (criado no startup), fora do event loop e com os componentes em paralelo.
+- Malha em CSR montado direto dos arrays de arestas (sem networkx); Dijkstra em C pelo scipy.sparse.csgraph.
+- Grafo local por requisição sem networkx: o CSR da malha somado aos nós/arestas extras numa cópia O(|E|) em C.
+- Partida rápida: malha reprojetada em GeoParquet e grafo montado em pickle, refeitos quando o shapefile muda.
 - Mensagens de erro mais descritivas em todos os pontos críticos.
 
-Requisitos: geopandas, networkx, shapely, pyproj, fastapi, pydantic
+Requisitos: geopandas, scipy, shapely, pyproj, fastapi, pydantic (pyarrow opcional, para o snapshot da malha)
 
 Exemplo rápido de payload JSON (test):
 [
@@ -20,20 +24,26 @@ Exemplo rápido de payload JSON (test):
 
 """
 
-import math
-import random
-import networkx as nx
+import asyncio
+import os
+import pickle
 import geopandas as gpd
+import shapely
 from shapely.geometry import Point
 from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel, validator
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, NamedTuple
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from pyproj import Transformer
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
-import hashlib
-import json
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.spatial import cKDTree
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # --- CRS transformers ---
 to3857 = Transformer.from_crs('EPSG:4326', 'EPSG:3857', always_xy=True)
@@ -84,167 +94,362 @@ class Buyer(BaseModel):
 # --- Configurações de custo ---
 PRECO_POR_KM = 3.09
 MULTIPLICADORES = {'paved': 1.0, 'gravel': 1.3, 'dirt': 1.6}
+MULTIPLICADOR_PADRAO = 1.2  # road_type fora de MULTIPLICADORES
 CUSTO_CC = 274.71
 
 # --- Carrega malha e monta grafo ---
-try:
-    malha = gpd.read_file("rodovia_2014_refeita.shp").to_crs(epsg=3857)
-except Exception as e:
-    raise RuntimeError("Erro ao carregar 'odovia_2014_refeita1.shp': {}".format(e))
-
-G = nx.Graph()
-
-def _distance_meters(a: Tuple[float, float], b: Tuple[float, float]) -> float:
-    return math.hypot(a[0]-b[0], a[1]-b[1])
-
-def add_edges_from_coords(coords: List[Tuple[float, float]], road_type: str = 'paved'):
-    multiplier = MULTIPLICADORES.get(road_type, 1.2)
-    for i in range(len(coords) - 1):
-        start = tuple(coords[i])
-        end = tuple(coords[i + 1])
-        distance_m = _distance_meters(start, end)
-        distance_km = distance_m / 1000.0
-        cost = distance_km * PRECO_POR_KM * multiplier
-        G.add_edge(start, end, weight=cost, length_km=distance_km, cc=CUSTO_CC)
-
-for _, row in malha.iterrows():
-    road_type = row.get('road_type', 'paved')
-    geom = row['geometry']
-    if geom is None:
-        continue
-    if geom.geom_type == 'LineString':
-        add_edges_from_coords(list(geom.coords), road_type)
-    elif geom.geom_type == 'MultiLineString':
-        for line in geom.geoms:
-            add_edges_from_coords(list(line.coords), road_type)
+SHAPEFILE = "rodovia_2014_refeita.shp"
+MALHA_SNAPSHOT = "rodovia_2014_3857.parquet"
+GRAFO_SNAPSHOT = "rodovia_2014_grafo.pkl"
+# A geometria fica no .shp e os atributos (road_type) no .dbf: mudar qualquer um invalida os snapshots
+SHAPEFILE_PARTES = (SHAPEFILE, os.path.splitext(SHAPEFILE)[0] + ".dbf")
+
+def shapefile_mtimes() -> Tuple[float, ...]:
+    return tuple(os.path.getmtime(p) for p in SHAPEFILE_PARTES if os.path.exists(p))
+
+def write_atomically(path: str, write) -> None:
+    # Escreve num arquivo temporário e só então troca pelo final: uma queda no meio da escrita
+    # não deixa um snapshot truncado no lugar
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def load_malha() -> gpd.GeoDataFrame:
+    # Usa o snapshot GeoParquet já em EPSG:3857 enquanto ele for mais novo que o shapefile;
+    # snapshot ilegível (corrompido, sem pyarrow) cai para a leitura do shapefile
+    if os.path.exists(MALHA_SNAPSHOT) and os.path.getmtime(MALHA_SNAPSHOT) >= max(shapefile_mtimes(), default=0.0):
+        try:
+            return gpd.read_parquet(MALHA_SNAPSHOT)
+        except Exception as e:
+            print(f"Snapshot da malha ignorado: {e}")
+    try:
+        malha = gpd.read_file(SHAPEFILE).to_crs(epsg=3857)
+    except Exception as e:
+        raise RuntimeError("Erro ao carregar '{}': {}".format(SHAPEFILE, e))
+    try:
+        write_atomically(MALHA_SNAPSHOT, malha.to_parquet)
+    except Exception as e:
+        print(f"Snapshot da malha não foi salvo: {e}")
+    return malha
+
+def build_road_edges(malha: gpd.GeoDataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Segmentos de todas as linhas de uma vez: (inícios, fins, custo)
+    lines = malha[malha.geometry.notna()].explode(index_parts=False)
+    lines = lines[lines.geom_type == 'LineString']
+    coords, owner = shapely.get_coordinates(lines.geometry.to_numpy(), return_index=True)
+    same_line = owner[1:] == owner[:-1]
+    starts = coords[:-1][same_line]
+    ends = coords[1:][same_line]
+    if 'road_type' in lines.columns:
+        multipliers = np.array([MULTIPLICADORES.get(t, MULTIPLICADOR_PADRAO) for t in lines['road_type']])
+    else:
+        multipliers = np.full(len(lines), MULTIPLICADORES['paved'])
+    distance_km = np.hypot(ends[:, 0] - starts[:, 0], ends[:, 1] - starts[:, 1]) / 1000.0
+    costs = distance_km * PRECO_POR_KM * multipliers[owner[:-1][same_line]]
+    return starts, ends, costs
+
+def intern_nodes(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Cada (x, y) distinto vira um id inteiro; devolve (xs, ys) por id e os ids de início/fim de cada segmento
+    unique_coords, ids = np.unique(np.concatenate([starts, ends]), axis=0, return_inverse=True)
+    ids = ids.reshape(-1)
+    return unique_coords[:, 0].copy(), unique_coords[:, 1].copy(), ids[:len(starts)], ids[len(starts):]
+
+def build_road_csr(n_nodes: int, u_ids: np.ndarray, v_ids: np.ndarray, costs: np.ndarray) -> sp.csr_array:
+    # CSR simétrico direto dos arrays de arestas: pesos contíguos em data/indices/indptr, sem dicts por aresta.
+    # Segmento repetido entre o mesmo par de nós fica com a última ocorrência (como em nx.Graph.add_edges_from)
+    lo, hi = np.minimum(u_ids, v_ids), np.maximum(u_ids, v_ids)
+    keep = lo != hi  # laços (segmentos de comprimento zero) não alteram distâncias nem componentes
+    lo, hi, costs = lo[keep], hi[keep], costs[keep]
+    _, first_in_reversed = np.unique((lo.astype(np.int64) * n_nodes + hi)[::-1], return_index=True)
+    last = len(lo) - 1 - first_in_reversed
+    lo, hi, costs = lo[last], hi[last], costs[last]
+    return sp.csr_array(
+        (np.concatenate([costs, costs]), (np.concatenate([lo, hi]), np.concatenate([hi, lo]))),
+        shape=(n_nodes, n_nodes)
+    )
+
+def build_road_graph() -> Tuple[np.ndarray, np.ndarray, sp.csr_array]:
+    starts, ends, costs = build_road_edges(load_malha())
+    road_xs, road_ys, u_ids, v_ids = intern_nodes(starts, ends)
+    if len(road_xs) == 0:
+        raise RuntimeError('Nenhum nó de estrada na malha carregada.')
+    # Malha imutável em CSR (índice i <-> (road_xs[i], road_ys[i])). O CSR é simétrico,
+    # então o Dijkstra pode usar directed=True (sem transposição)
+    return road_xs, road_ys, build_road_csr(len(road_xs), u_ids, v_ids, costs)
+
+# Muda quando o conteúdo do snapshot do grafo muda, invalidando snapshots antigos
+GRAFO_FORMATO = 2
+
+def grafo_snapshot_key() -> Tuple[Any, ...]:
+    # Tudo de que dependem os pesos do CSR salvo: formato, .shp/.dbf e as constantes de custo por km
+    return (GRAFO_FORMATO, shapefile_mtimes(), PRECO_POR_KM,
+            tuple(sorted(MULTIPLICADORES.items())), MULTIPLICADOR_PADRAO)
+
+def load_road_graph() -> Tuple[np.ndarray, np.ndarray, sp.csr_array]:
+    # Reaproveita o grafo montado numa partida anterior se nada de que ele depende mudou desde então
+    key = grafo_snapshot_key()
+    try:
+        with open(GRAFO_SNAPSHOT, 'rb') as f:
+            snapshot = pickle.load(f)
+        if snapshot['chave'] == key:
+            return snapshot['grafo']
+    except Exception:
+        pass
+    grafo = build_road_graph()
+
+    def dump(path: str) -> None:
+        with open(path, 'wb') as f:
+            pickle.dump({'chave': key, 'grafo': grafo}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    try:
+        write_atomically(GRAFO_SNAPSHOT, dump)
+    except Exception as e:
+        print(f"Snapshot do grafo não foi salvo: {e}")
+    return grafo
+
+road_xs, road_ys, ROAD_CSR = load_road_graph()
 
 # --- Indexação dos nós em arrays para busca vetorizada ---
-road_nodes = [n for n in G.nodes if isinstance(n, tuple) and len(n) == 2]
-if not road_nodes:
-    raise RuntimeError('Nenhum nó de estrada na malha carregada.')
-road_nodes_arr = np.array(road_nodes)
+road_nodes_arr = np.column_stack((road_xs, road_ys))
+_road_kdt = cKDTree(road_nodes_arr)
+
+# --- Componentes da malha ---
+_, road_labels = connected_components(ROAD_CSR, directed=False)
 
 # --- Funções utilitárias ---
 
-def connect_to_nearest_node(graph: nx.Graph, point_id: str, coord: Tuple[float, float]) -> Tuple[float, float]:
-    # Busca vetorizada: encontra índice do nó de estrada mais próximo via numpy
-    pt = np.array(coord)
-    deltas = road_nodes_arr - pt
-    dists = np.hypot(deltas[:,0], deltas[:,1])
-    idx = int(dists.argmin())
-    nearest_node = tuple(road_nodes_arr[idx])
-    distance_km = dists[idx] / 1000.0
+def connect_to_nearest_node(point_idx: int, coord: Tuple[float, float]) -> Tuple[int, int, float]:
+    # Consulta O(log N) na KD-tree dos nós de estrada; devolve a aresta (ponto, nó de estrada, custo)
+    dist, idx = _road_kdt.query(coord, k=1)
+    distance_km = dist / 1000.0
     cost = distance_km * PRECO_POR_KM + CUSTO_CC
-    graph.add_node(point_id, coord=coord)
-    graph.add_edge(point_id, nearest_node, weight=cost, length_km=distance_km, cc=CUSTO_CC)
-    return nearest_node
-
-
-def hash_markers(markers: List[FrontendMarker]) -> str:
-    # Serializa os dados relevantes
-    serialized = json.dumps([{
-        'type': m.type,
-        'coords': {'lat': m.coords.lat, 'lng': m.coords.lng} if m.coords else None,
-        'quantidade': m.quantidade
-    } for m in markers], sort_keys=True)
-    return hashlib.md5(serialized.encode()).hexdigest()
-
-
-
-# --- Pré-cálculo de distâncias (serial, estável) ---
-
-def compute_distance_maps(graph: nx.Graph, sources: List[str], targets_filter: set) -> Dict[str, Dict[Any, float]]:
-    distances = {}
-    for s in sources:
-        try:
-            lengths = nx.single_source_dijkstra_path_length(graph, s, weight='weight')
-        except nx.NetworkXNoPath:
-            lengths = {}
-        if targets_filter is not None:
-            lengths = {k: v for k, v in lengths.items() if k in targets_filter}
-        distances[s] = lengths
+    return point_idx, int(idx), cost
+
+
+class LocalGraph(NamedTuple):
+    csr: sp.csr_array
+    point_index: Dict[str, int]  # id do produtor/mercado -> índice no CSR
+
+
+def overlay_graph(extra_edges: List[Tuple[int, int, float]], n_extra: int) -> sp.csr_array:
+    # Malha + nós/arestas extras da requisição: o indptr de ROAD_CSR ganha n_extra linhas vazias e as arestas
+    # extras entram como uma matriz esparsa simétrica. A soma gera um CSR novo (cópia O(|E|) em C, ~14 ms na
+    # malha toda); ROAD_CSR não é alterado
+    n = ROAD_CSR.shape[0] + n_extra
+    indptr = np.concatenate([ROAD_CSR.indptr, np.full(n_extra, ROAD_CSR.indptr[-1], dtype=ROAD_CSR.indptr.dtype)])
+    base = sp.csr_array((ROAD_CSR.data, ROAD_CSR.indices, indptr), shape=(n, n))
+    if not extra_edges:
+        return base
+    u, v, w = (np.asarray(a) for a in zip(*extra_edges))
+    extra = sp.csr_array((np.concatenate([w, w]), (np.concatenate([u, v]), np.concatenate([v, u]))), shape=(n, n))
+    return (base + extra).tocsr()
+
+
+def walk_predecessors(predecessors: np.ndarray, target: int) -> List[int]:
+    # Caminho origem -> alvo a partir da linha de predecessores do Dijkstra (negativo marca a origem)
+    path = []
+    node = target
+    while node >= 0:
+        path.append(node)
+        node = predecessors[node]
+    return path[::-1]
+
+
+class LRUCache(OrderedDict):
+    # dict com tamanho máximo: get() renova a entrada e inserir acima de maxsize descarta a mais antiga
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+def marker_key(markers: List[FrontendMarker]) -> Tuple[Tuple[Any, ...], ...]:
+    # Chave do cache: tupla com os dados relevantes, usada direto no dict (hash nativo de tupla,
+    # sem JSON/MD5 e sem risco de colisão, já que o dict ainda compara por igualdade)
+    return tuple(
+        (m.type, m.coords.lat, m.coords.lng, m.quantidade) if m.coords else (m.type, None, None, m.quantidade)
+        for m in markers
+    )
+
+
+
+# --- Pré-cálculo de distâncias (Dijkstra do SciPy sobre CSR) ---
+
+# rows: dict da requisição com as linhas (distâncias, predecessores) do Dijkstra por origem. Cada linha cobre a malha
+# inteira (~5.7 MB), então elas vivem só durante a requisição: o fitness as preenche e as rotas as reaproveitam
+def shortest_path_rows(graph: LocalGraph, sources: List[str],
+                       rows: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    missing = [s for s in sources if s not in rows]
+    if missing:
+        # Uma única chamada em C para todas as origens ainda não calculadas
+        dist, pred = dijkstra(graph.csr, directed=True, return_predecessors=True,
+                              indices=[graph.point_index[s] for s in missing])
+        for s, dist_row, pred_row in zip(missing, dist, pred):
+            rows[s] = (dist_row, pred_row)
+    return rows
+
+def compute_distance_maps(graph: LocalGraph, sources: List[str], possible_nodes: np.ndarray,
+                          rows: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
+    # Matriz densa (len(sources), len(possible_nodes)); np.inf onde não há caminho
+    rows = shortest_path_rows(graph, sources, rows)
+    distances = np.empty((len(sources), len(possible_nodes)))
+    for i, s in enumerate(sources):
+        distances[i] = rows[s][0][possible_nodes]
     return distances
 
-# --- Função de fitness ---
-
-def fitness_from_maps(candidate: Any,
-                      producers: List[Producer], buyers: List[Buyer],
-                      dist_producers: Dict[str, Dict[Any, float]],
-                      dist_buyers: Dict[str, Dict[Any, float]]) -> float:
-    total_cost = 0.0
-    for p in producers:
-        dmap = dist_producers.get(p.id, {})
-        if candidate not in dmap:
-            return 0.0
-        total_cost += dmap[candidate] * p.quantidade
-    for b in buyers:
-        dmap_b = dist_buyers.get(b.id, {})
-        if candidate not in dmap_b:
-            return 0.0
-        total_cost += dmap_b[candidate] * b.demanda
-    return 1.0 / (1.0 + total_cost) if total_cost > 0 else 0.0
-
-# --- GA com paralelização das avaliações ---
-
-def parallel_evaluate(population: List[Any], producers: List[Producer], buyers: List[Buyer],
-                      dist_producers: Dict[str, Dict[Any, float]], dist_buyers: Dict[str, Dict[Any, float]],
-                      max_workers: int = None) -> List[Tuple[Any, float]]:
-    results = []
-    with ThreadPoolExecutor(max_workers=max_workers) as exe:
-        future_to_ind = {exe.submit(fitness_from_maps, ind, producers, buyers, dist_producers, dist_buyers): ind for ind in population}
-        for fut in as_completed(future_to_ind):
-            ind = future_to_ind[fut]
-            try:
-                fit = fut.result()
-                if fit > 0:
-                    results.append((ind, fit))
-            except Exception:
-                # Se uma avaliação falhar, ignoramos o indivíduo
-                continue
-    return results
-
-def genetic_algorithm(graph: nx.Graph, possible_nodes: List[Any], producers: List[Producer], buyers: List[Buyer],
-                      generations: int = 1000, population_size: int = 100, mutation_rate: float = 0.01,
-                      max_workers: int = None):
+# --- Função de fitness (vetorizada sobre todos os candidatos) ---
+
+def fitness_vector(producers: List[Producer], buyers: List[Buyer],
+                   dist_producers: np.ndarray, dist_buyers: np.ndarray) -> np.ndarray:
+    q = np.array([p.quantidade for p in producers], dtype=float)
+    d = np.array([b.demanda for b in buyers], dtype=float)
+    # Candidato sem caminho para algum produtor/mercado tem fitness 0
+    reachable = np.isfinite(dist_producers).all(axis=0) & np.isfinite(dist_buyers).all(axis=0)
+    with np.errstate(invalid='ignore'):
+        total_cost = q @ dist_producers + d @ dist_buyers
+    valid = reachable & (total_cost > 0)
+    return np.where(valid, 1.0 / (1.0 + np.where(valid, total_cost, 0.0)), 0.0)
+
+# --- GA sobre índices em possible_nodes ---
+
+def evaluate_population(population: np.ndarray, fitness: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Índices válidos (fitness > 0) da população e seus fitness
+    fits = fitness[population]
+    valid = fits > 0
+    return population[valid], fits[valid]
+
+def top_k(inds: np.ndarray, fits: np.ndarray, k: int) -> np.ndarray:
+    # k melhores indivíduos via argpartition (O(n)), sem ordenar a população inteira
+    return inds[np.argpartition(fits, -k)[-k:]]
+
+# --- Poda dos candidatos (1-mediana) ---
+CANDIDATE_FRACTION = 0.05
+MIN_CANDIDATES = 500
+
+def prune_candidates(possible_nodes: np.ndarray, producers: List[Producer], buyers: List[Buyer],
+                     anchor_nodes: List[int]) -> np.ndarray:
+    # O ótimo da 1-mediana fica perto do centróide ponderado dos pontos: mantém os K nós do componente
+    # mais próximos dele (K = CANDIDATE_FRACTION do componente) e o nó de estrada de cada produtor/mercado
+    k = max(MIN_CANDIDATES, int(len(possible_nodes) * CANDIDATE_FRACTION))
+    if k >= len(possible_nodes):
+        return possible_nodes
+    coords = np.array([p.coord for p in producers] + [b.coord for b in buyers])
+    weights = np.array([p.quantidade for p in producers] + [b.demanda for b in buyers], dtype=float)
+    centroid = weights @ coords / weights.sum() if weights.sum() > 0 else coords.mean(axis=0)
+    dists = np.hypot(road_xs[possible_nodes] - centroid[0], road_ys[possible_nodes] - centroid[1])
+    nearest = possible_nodes[np.argpartition(dists, k)[:k]]
+    return np.union1d(nearest, anchor_nodes)
+
+def candidate_fitness(graph: LocalGraph, possible_nodes: np.ndarray, producers: List[Producer],
+                      buyers: List[Buyer], rows: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
     if len(possible_nodes) == 0:
         raise ValueError("Lista de possíveis nós está vazia.")
-    population_size = min(population_size, len(possible_nodes))
-    possible_set = set(possible_nodes)
-    dist_producers = compute_distance_maps(graph, [p.id for p in producers], possible_set)
-    dist_buyers = compute_distance_maps(graph, [b.id for b in buyers], possible_set)
-    population = random.sample(possible_nodes, population_size)
+    dist_producers = compute_distance_maps(graph, [p.id for p in producers], possible_nodes, rows)
+    dist_buyers = compute_distance_maps(graph, [b.id for b in buyers], possible_nodes, rows)
+    return fitness_vector(producers, buyers, dist_producers, dist_buyers)
+
+# Progresso do GA só a cada GA_LOG_EVERY gerações (print síncrono no laço custa caro)
+GA_LOG_EVERY = 50
+
+# Parada por fitness estável: sem melhora relativa acima de STEADY_TOL por STEADY_PATIENCE gerações
+STEADY_TOL = 1e-6
+STEADY_PATIENCE = 200
+
+def genetic_algorithm(fitness: np.ndarray, generations: int = 1000, population_size: int = 100,
+                      mutation_rate: float = 0.01, patience: int = STEADY_PATIENCE) -> Tuple[int, float]:
+    # Roda no pool de processos: recebe só o vetor de fitness e devolve (índice do candidato, custo)
+    rng = np.random.default_rng()
+    n_candidates = len(fitness)
+    population_size = min(population_size, n_candidates)
+    population = rng.choice(n_candidates, size=population_size, replace=False)
+    best_fit_seen = 0.0
+    steady = 0
+    gens_run = 0
 
     for gen in range(generations):
-        evaluated = parallel_evaluate(population, producers, buyers, dist_producers, dist_buyers, max_workers=max_workers)
-        if not evaluated:
+        gens_run = gen + 1
+        inds, fits = evaluate_population(population, fitness)
+        if inds.size == 0:
             raise ValueError(f"Nenhum indivíduo válido na geração {gen}.")
-        evaluated.sort(key=lambda x: x[1], reverse=True)
-        top = [ind for ind, _ in evaluated[: max(2, len(evaluated)//2)]]
-        new_pop = []
-        while len(new_pop) < population_size:
-            if len(top) >= 2:
-                p1, p2 = random.sample(top, 2)
-            else:
-                p1 = p2 = top[0]
-            child = random.choice([p1, p2])
-            if random.random() < mutation_rate:
-                child = random.choice(possible_nodes)
-            new_pop.append(child)
-        population = new_pop
-        best_node_temp, best_fit_temp = max(evaluated, key=lambda x: x[1])
-        best_cost_temp = (1.0 / best_fit_temp) - 1.0
-        print(f"Na geração {gen} o melhor node foi {best_node_temp} com {best_cost_temp} de custo")
-
-
-    final_eval = parallel_evaluate(population, producers, buyers, dist_producers, dist_buyers, max_workers=max_workers)
-    if not final_eval:
+        gen_best_fit = fits.max()
+        if gen_best_fit > best_fit_seen * (1.0 + STEADY_TOL):
+            best_fit_seen = gen_best_fit
+            steady = 0
+        else:
+            steady += 1
+        if steady >= patience:
+            break
+        top = top_k(inds, fits, min(inds.size, max(2, inds.size//2)))
+        # Filho = um de dois pais sorteados do top, o que equivale a sortear direto do top
+        children = rng.choice(top, size=population_size)
+        mutate = rng.random(population_size) < mutation_rate
+        children[mutate] = rng.integers(0, n_candidates, size=int(mutate.sum()))
+        population = children
+        if gen % GA_LOG_EVERY == 0:
+            best_pos = int(fits.argmax())
+            best_cost_temp = (1.0 / fits[best_pos]) - 1.0
+            print(f"Na geração {gen} o melhor candidato foi {inds[best_pos]} com {best_cost_temp} de custo")
+
+    inds, fits = evaluate_population(population, fitness)
+    if inds.size == 0:
         raise ValueError("Não foi possível encontrar ponto ótimo válido.")
-    best_node, best_fit = max(final_eval, key=lambda x: x[1])
+    best_pos = int(fits.argmax())
+    best_ind, best_fit = int(inds[best_pos]), float(fits[best_pos])
     best_cost = (1.0 / best_fit) - 1.0
-    return best_node, best_cost
+    print(f"GA concluído após {gens_run} gerações: melhor candidato {best_ind} com {best_cost} de custo")
+    return best_ind, best_cost
 
 # --- FastAPI app e endpoint ---
-app = FastAPI()
+
+# Pool de processos persistente para o GA (criado uma vez, não por requisição)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    yield
+    app.state.pool.shutdown()
+
+def renew_ga_pool(app: FastAPI, broken: ProcessPoolExecutor):
+    # Um worker morto (OOM, kill) quebra o pool inteiro: troca por um novo, uma vez só mesmo com
+    # várias requisições vendo o mesmo pool quebrado
+    if app.state.pool is broken:
+        print("Pool de processos do GA quebrado; criando um novo.")
+        app.state.pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+        broken.shutdown(wait=False)
+
+async def evolve_in_pool(app: FastAPI, fitnesses: List[np.ndarray]) -> List[Any]:
+    # GA fora do event loop, num processo do pool; os componentes evoluem em paralelo. Com o pool
+    # quebrado (na submissão ou durante a execução) troca o pool e tenta mais uma vez
+    loop = asyncio.get_running_loop()
+    for _ in range(2):
+        pool = app.state.pool
+        try:
+            results = await asyncio.gather(
+                *(loop.run_in_executor(pool, genetic_algorithm, fitness) for fitness in fitnesses),
+                return_exceptions=True
+            )
+        except BrokenProcessPool:
+            results = None
+        if results is not None and not any(isinstance(r, BrokenProcessPool) for r in results):
+            return results
+        renew_ga_pool(app, pool)
+    raise HTTPException(status_code=503, detail="Pool de processos do GA indisponível; tente novamente.")
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:8081"],
@@ -253,14 +458,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-cache = {}
+# Respostas por conjunto de marcadores, limitado para não crescer sem fim num servidor de longa duração
+RESPONSE_CACHE_MAX = 512
+cache = LRUCache(RESPONSE_CACHE_MAX)
 
 @app.post("/find-optimal-location/")
 async def find_optimal_location(markers: List[FrontendMarker], request: Request):
-    marker_hash = hash_markers(markers)
+    cache_key = marker_key(markers)
 
-    if marker_hash in cache:
-        return cache[marker_hash]
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
 
     
     # Parse e validação
@@ -284,65 +492,61 @@ async def find_optimal_location(markers: List[FrontendMarker], request: Request)
     if not producers_data or not buyers_data:
         raise HTTPException(status_code=400, detail="Você precisa de pelo menos um produtor e um mercado.")
 
-    local_G = G.copy()
-    all_point_ids = [p.id for p in producers_data] + [b.id for b in buyers_data]
+    # Grafo local: nós extras (produtores/mercados) recebem índices após os nós de estrada
+    n_road = len(road_xs)
+    points = producers_data + buyers_data
+    point_index = {pt.id: n_road + i for i, pt in enumerate(points)}
+    extra_edges = [connect_to_nearest_node(point_index[pt.id], pt.coord) for pt in points]
+
+    # Cada ponto entra como folha de um nó de estrada, então os componentes são os da malha
+    point_road_nodes = {pt.id: road_idx for pt, (_, road_idx, _) in zip(points, extra_edges)}
+    point_labels = {pid: road_labels[road_idx] for pid, road_idx in point_road_nodes.items()}
+    viable_labels = sorted(
+        set(point_labels[p.id] for p in producers_data) & set(point_labels[b.id] for b in buyers_data)
+    )
+    component_road_nodes = {lab: np.flatnonzero(road_labels == lab) for lab in viable_labels}
     
-    for p in producers_data:
-        connect_to_nearest_node(local_G, p.id, p.coord)
-    for b in buyers_data:
-        connect_to_nearest_node(local_G, b.id, b.coord)
-
-    # --- This is the new section that connects the components ---
-    components = list(nx.connected_components(local_G.to_undirected()))
-    
-    # Use frozenset to create hashable keys
-    producer_components = {frozenset(comp): [p for p in producers_data if p.id in comp] for comp in components}
-    buyer_components = {frozenset(comp): [b for b in buyers_data if b.id in comp] for comp in components}
-
-    # Now, find viable components using the frozenset keys
-    viable_components_keys = [fcomp for fcomp, prods in producer_components.items() if prods and buyer_components[fcomp]]
-    
-    if len(viable_components_keys) > 1:
+    if len(viable_labels) > 1:
         print("Múltiplos componentes viáveis encontrados. Conectando-os...")
         
         # Lógica para encontrar os nós mais próximos entre componentes
-        for i in range(len(viable_components_keys) - 1):
-            comp1_key = viable_components_keys[i]
-            comp2_key = viable_components_keys[i+1]
-            
-            # Use os frozenset keys para acessar os componentes originais
-            nodes1 = np.array([n for n in comp1_key if isinstance(n, tuple) and len(n) == 2])
-            nodes2 = np.array([n for n in comp2_key if isinstance(n, tuple) and len(n) == 2])
+        for i in range(len(viable_labels) - 1):
+            idx_nodes1 = component_road_nodes[viable_labels[i]]
+            idx_nodes2 = component_road_nodes[viable_labels[i+1]]
+            nodes1 = road_nodes_arr[idx_nodes1]
+            nodes2 = road_nodes_arr[idx_nodes2]
             
             if nodes1.size > 0 and nodes2.size > 0:
-                from_nodes = np.repeat(nodes1, len(nodes2), axis=0)
-                to_nodes = np.tile(nodes2, (len(nodes1), 1))
-                dists = np.hypot(from_nodes[:,0] - to_nodes[:,0], from_nodes[:,1] - to_nodes[:,1])
-                
-                min_idx = dists.argmin()
-                idx1 = min_idx // len(nodes2)
-                idx2 = min_idx % len(nodes2)
+                # Vizinho mais próximo em nodes2 para cada nó de nodes1: memória O(|C1|+|C2|)
+                dists, nearest = cKDTree(nodes2).query(nodes1, k=1)
+                idx1 = int(dists.argmin())
                 
-                closest_node1 = tuple(nodes1[idx1])
-                closest_node2 = tuple(nodes2[idx2])
+                closest_node1 = int(idx_nodes1[idx1])
+                closest_node2 = int(idx_nodes2[nearest[idx1]])
                 
-                distance_km = dists[min_idx] / 1000.0
+                distance_km = dists[idx1] / 1000.0
                 cost = distance_km * PRECO_POR_KM + CUSTO_CC
                 
-                print(f"Adicionando aresta entre {closest_node1} e {closest_node2} com custo {cost:.2f}")
-                local_G.add_edge(closest_node1, closest_node2, weight=cost, length_km=distance_km, cc=CUSTO_CC)
+                print(f"Adicionando aresta entre {tuple(nodes1[idx1].tolist())} e {tuple(nodes2[nearest[idx1]].tolist())} com custo {cost:.2f}")
+                extra_edges.append((closest_node1, closest_node2, cost))
     
     
+    local_graph = LocalGraph(overlay_graph(extra_edges, len(points)), point_index)
+    # Linhas do Dijkstra desta requisição, preenchidas pelo fitness e reaproveitadas nas rotas
+    sssp_rows: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
     component_nodes = []
-    for comp in components:
-        comp_producers = [p.id for p in producers_data if p.id in comp]
-        comp_buyers = [b.id for b in buyers_data if b.id in comp]
-        if comp_producers and comp_buyers:
-            component_nodes.append({
-                'producers': comp_producers,
-                'buyers': comp_buyers,
-                'possible_nodes': [n for n in comp if isinstance(n, tuple) and len(n) == 2]
-            })
+    for lab in viable_labels:
+        comp_producers = [p for p in producers_data if point_labels[p.id] == lab]
+        comp_buyers = [b for b in buyers_data if point_labels[b.id] == lab]
+        component_nodes.append({
+            'producers': comp_producers,
+            'buyers': comp_buyers,
+            'possible_nodes': prune_candidates(
+                component_road_nodes[lab], comp_producers, comp_buyers,
+                [point_road_nodes[pt.id] for pt in comp_producers + comp_buyers]
+            )
+        })
 
     if not component_nodes:
         raise HTTPException(status_code=400, detail="Nenhum componente contém produtores e mercados conectados.")
@@ -351,60 +555,75 @@ async def find_optimal_location(markers: List[FrontendMarker], request: Request)
     best_overall_node = None
     best_overall_cost = float('inf')
 
+    runs = []
     for comp in component_nodes:
         try:
-            node, cost = genetic_algorithm(
-                local_G,
+            fitness = candidate_fitness(
+                local_graph,
                 comp['possible_nodes'],
-                [p for p in producers_data if p.id in comp['producers']],
-                [b for b in buyers_data if b.id in comp['buyers']],
-                max_workers=None
+                comp['producers'],
+                comp['buyers'],
+                sssp_rows
             )
-            if cost < best_overall_cost:
-                best_overall_cost = cost
-                best_overall_node = node
         except Exception:
             continue
+        runs.append((comp, fitness))
+
+    results = await evolve_in_pool(request.app, [fitness for _, fitness in runs])
+    for (comp, _), result in zip(runs, results):
+        if isinstance(result, Exception):
+            continue
+        best_ind, cost = result
+        if cost < best_overall_cost:
+            best_overall_cost = cost
+            best_overall_node = int(comp['possible_nodes'][best_ind])
 
     if best_overall_node is None:
         raise HTTPException(status_code=500, detail="Não foi possível encontrar ponto ótimo em nenhum componente.")
 
-    paths_coords = []
-    for p in producers_data + buyers_data:
-        try:
-            path = nx.shortest_path(local_G, source=p.id, target=best_overall_node, weight='weight')
-            coords_path = []
-            for node in path:
-                if isinstance(node, tuple):
-                    lon, lat = to4326.transform(node[0], node[1])
-                    coords_path.append([lat, lon])
-            paths_coords.append(coords_path)
-        except nx.NetworkXNoPath:
+    # Rotas reconstruídas a partir dos predecessores já calculados para o fitness, sem novo Dijkstra.
+    # Só pontos de componentes viáveis têm linha, e os demais não alcançam o ponto ótimo
+    paths = []
+    for pt in points:
+        if pt.id not in sssp_rows:
+            continue
+        dist_row, pred_row = sssp_rows[pt.id]
+        if np.isinf(dist_row[best_overall_node]):
             continue
+        path = np.array(walk_predecessors(pred_row, best_overall_node))
+        paths.append(path[path < n_road])
+
+    # Uma única transformação para EPSG:4326 com todos os nós distintos das rotas (e o ponto ótimo)
+    unique_nodes, inverse = np.unique(np.concatenate(paths + [[best_overall_node]]), return_inverse=True)
+    lons, lats = to4326.transform(road_xs[unique_nodes], road_ys[unique_nodes])
+    latlon = np.column_stack((lats, lons))[inverse]
+    *paths_latlon, best_latlon = np.split(latlon, np.cumsum([len(p) for p in paths]))
+    paths_coords = [p.tolist() for p in paths_latlon]
 
-    lon, lat = to4326.transform(best_overall_node[0], best_overall_node[1])
+    lat, lon = best_latlon[0].tolist()
     resultado = {
         'optimal_location_coord': {'lat': lat, 'lng': lon},
         'total_cost': f'{best_overall_cost:.2f}',
         'routes': paths_coords
     }
-    cache[marker_hash] = resultado
-    return resultado
+    # JSONResponse evita o jsonable_encoder do FastAPI; o cache guarda o corpo já serializado
+    response = JSONResponse(content=resultado)
+    cache[cache_key] = response.body
+    return response
 
 
 
 
 @app.post("/find-optimal-location-test/")
 async def find_optimal_location(markers: List[FrontendMarker], request: Request):
-    local_G = G.copy()   
     roads_coords = []
-    for u, v in local_G.edges():
-        # cada u e v são nós com coordenadas (x, y) em EPSG:3857
-        if isinstance(u, tuple) and isinstance(v, tuple):
-            lon_u, lat_u = to4326.transform(u[0], u[1])
-            lon_v, lat_v = to4326.transform(v[0], v[1])
-            # salva cada rodovia como linha entre 2 pontos
-            roads_coords.append([[lat_u, lon_u], [lat_v, lon_v]])
+    edges = sp.triu(ROAD_CSR).tocoo()
+    for u, v in zip(edges.row.tolist(), edges.col.tolist()):
+        # cada u e v são ids de nós com coordenadas (road_xs, road_ys) em EPSG:3857
+        lon_u, lat_u = to4326.transform(road_xs[u], road_ys[u])
+        lon_v, lat_v = to4326.transform(road_xs[v], road_ys[v])
+        # salva cada rodovia como linha entre 2 pontos
+        roads_coords.append([[lat_u, lon_u], [lat_v, lon_v]])
     return {
         'optimal_location_coord': {'lat': 20, 'lng': 20},
         'total_cost': f'{20}',